@@ -1,5 +1,6 @@
 
 import arrow
+import copy
 import defusedxml.lxml
 import libvirt
 import lxml
@@ -16,6 +17,9 @@ class MockDomain():
     """
     Simulate a libvirt domain
     """
+    #: parsed testdomain.xml, read once for all domains
+    _template_dom_xml = None
+
     def XMLDesc(self):
         """
         Return the definition of a testing domain
@@ -87,11 +91,21 @@ class MockDomain():
         self._conn = _conn
         self._state = [1, 1]
 
-        with open(os.path.join(CUR_PATH, "testdomain.xml")) as dom_xmlfile:
-            self.dom_xml = defusedxml.lxml.fromstring(dom_xmlfile.read())
+        # the tests modify the domain XML, so each domain gets its own copy
+        self.dom_xml = copy.deepcopy(self._get_template_dom_xml())
         self.set_id(id)
         self.set_name(name)
 
+    @classmethod
+    def _get_template_dom_xml(cls):
+        if cls._template_dom_xml is None:
+            xml_path = os.path.join(CUR_PATH, "testdomain.xml")
+            with open(xml_path) as dom_xmlfile:
+                cls._template_dom_xml = defusedxml.lxml.fromstring(
+                    dom_xmlfile.read()
+                )
+        return cls._template_dom_xml
+
 
 class MockSnapshot():
     def getName(self):
@@ -146,10 +160,7 @@ def build_complete_backup_files_from_domainbackup(dbackup, date):
 
     if dbackup.compression:
         tar = dbackup.get_new_tar(backup_dir, date)
-        if dbackup.compression == "xz":
-            definition["tar"] = tar.fileobj._fp.name
-        else:
-            definition["tar"] = tar.fileobj.name
+        definition["tar"] = tar.name
     for disk in dbackup.disks:
         # create empty files as our backup images
         img_name = "{}.qcow2".format(
@@ -2,7 +2,7 @@
 import pytest
 
 from virt_backup.domains import (
-    search_domains_regex, get_domain_disks_of,
+    search_domains_regex, get_domain_disks_of, parse_libvirt_xml
 )
 from virt_backup.exceptions import DiskNotFoundError
 
@@ -22,6 +22,13 @@ def test_get_domain_disks_of_disk_not_found(build_mock_domain):
         get_domain_disks_of(domain.XMLDesc(), "vda", "vdc")
 
 
+def test_parse_libvirt_xml(build_mock_domain):
+    dom_xml = parse_libvirt_xml(build_mock_domain.XMLDesc())
+
+    assert dom_xml.tag == "domain"
+    assert get_domain_disks_of(dom_xml, "vda")
+
+
 def test_search_domains_regex(build_mock_libvirtconn):
     conn = build_mock_libvirtconn
     domain_names = ("dom1", "dom2", "dom3", "test")
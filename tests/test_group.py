@@ -1,13 +1,18 @@
+from collections import deque
 import os
+import threading
 import pytest
 
 from virt_backup.groups import BackupGroup, groups_from_dict
+from virt_backup.groups.pending import _pop_or_steal
 from virt_backup.groups.pattern import (
     pattern_matching_domains_in_libvirt,
     matching_libvirt_domains_from_config
 )
 from virt_backup.backups import DomBackup, DomExtSnapshotCallbackRegistrer
-from virt_backup.exceptions import BackupsFailureInGroupError
+from virt_backup.exceptions import (
+    BackupCancelledError, BackupsFailureInGroupError
+)
 
 from helper.virt_backup import MockDomain, build_backup_group, build_dombackup
 
@@ -152,6 +157,64 @@ class TestBackupGroup():
 
         assert backup_group.backups[1].start.called
 
+    def test_start_multithread_fail_fast(self, build_mock_libvirtconn):
+        """
+        With one thread, the first backup fails and cancels the others
+        """
+        conn = build_mock_libvirtconn
+        backup_group = build_backup_group(
+            conn, domlst=(
+                MockDomain(_conn=conn, name="test1", id=1),
+                MockDomain(_conn=conn, name="test2", id=2),
+                MockDomain(_conn=conn, name="test3", id=3),
+            )
+        )
+        started = []
+
+        def error_start(*args, **kwargs):
+            started.append(kwargs["cancel_event"])
+            raise Exception()
+
+        for b in backup_group.backups:
+            b.start = error_start
+
+        with pytest.raises(BackupsFailureInGroupError) as e:
+            backup_group.start_multithread(1, fail_fast=True)
+
+        assert len(started) == 1
+        assert started[0].is_set()
+        cancelled = [
+            dom_name for dom_name, exc in e.value.exceptions.items()
+            if isinstance(exc, BackupCancelledError)
+        ]
+        assert len(e.value.exceptions) == 3
+        assert len(cancelled) == 2
+
+    def test_start_backups_fail_fast(self, build_mock_libvirtconn, mocker):
+        conn = build_mock_libvirtconn
+        backup_group = build_backup_group(
+            conn, domlst=(
+                MockDomain(_conn=conn, name="test_error"),
+                MockDomain(_conn=conn),
+            )
+        )
+
+        def error_start(*args, **kwargs):
+            raise Exception()
+
+        backup_group.backups[0].start = error_start
+        backup_group.backups[1].start = mocker.stub()
+
+        cancel_event = threading.Event()
+        completed, errors = backup_group._start_backups(
+            backup_group.backups, cancel_event
+        )
+
+        assert cancel_event.is_set()
+        assert not completed
+        assert isinstance(errors["test"], BackupCancelledError)
+        assert not backup_group.backups[1].start.called
+
     def test_propagate_attr(self, build_mock_libvirtconn, build_mock_domain):
         backup_group = build_backup_group(
             conn=build_mock_libvirtconn, domlst=(build_mock_domain, ),
@@ -187,6 +250,17 @@ class TestBackupGroup():
             assert b.target_dir == "/test"
 
 
+def test_pop_or_steal():
+    local_queues = [deque((1, 2)), deque((3, 4))]
+
+    assert _pop_or_steal(local_queues, 0) == 2
+    assert _pop_or_steal(local_queues, 0) == 1
+    # own queue is empty, steal from the other side of the other queue
+    assert _pop_or_steal(local_queues, 0) == 3
+    assert _pop_or_steal(local_queues, 1) == 4
+    assert _pop_or_steal(local_queues, 1) is None
+
+
 def test_pattern_matching_domains_in_libvirt_regex(
         build_mock_libvirtconn_filled
 ):
@@ -199,6 +273,23 @@ def test_pattern_matching_domains_in_libvirt_regex(
     assert not exclude
 
 
+def test_pattern_matching_domains_in_libvirt_regex_listed_domains(
+        build_mock_libvirtconn_filled
+):
+    """
+    Test a regex with the domains already listed
+    """
+    conn = build_mock_libvirtconn_filled
+    domain_names = tuple(d.name() for d in conn.listAllDomains())
+    matches = pattern_matching_domains_in_libvirt(
+        "r:^matching.?$", conn, domain_names
+    )
+    domains = tuple(sorted(matches["domains"]))
+
+    assert domains == ("matching", "matching2")
+    assert not matches["exclude"]
+
+
 def test_pattern_matching_domains_in_libvirt_direct_name(
         build_mock_libvirtconn_filled
 ):
@@ -1,4 +1,7 @@
+import arrow
+import subprocess
 import tarfile
+import threading
 import datetime
 import json
 import pytest
@@ -8,6 +11,7 @@ from virt_backup.backups import DomBackup
 from virt_backup.backups.snapshot import (
     DomExtSnapshot, DomExtSnapshotCallbackRegistrer
 )
+from virt_backup.exceptions import BackupCancelledError
 from helper.virt_backup import MockSnapshot, build_dombackup
 
 
@@ -81,6 +85,17 @@ class TestDomBackup():
         }
         assert dombkup.disks == expected_disks
 
+    def test_add_already_added_disks(self, build_mock_domain, mocker):
+        """
+        Adding disks already backup should not pull the domain XML
+        """
+        dombkup = build_dombackup(build_mock_domain, dev_disks=("vda", ))
+        mocker.spy(build_mock_domain, "XMLDesc")
+
+        dombkup.add_disks("vda")
+        assert not build_mock_domain.XMLDesc.called
+        assert tuple(dombkup.disks.keys()) == ("vda", )
+
     def test_add_not_existing_disk(self, get_dombackup):
         """
         Create a DomBackup and test to add vdc
@@ -106,6 +121,7 @@ class TestDomBackup():
         assert definition.items() <= pending_info.items()
         assert "snapshot" in pending_info["disks"]["vda"]
         assert "src" in pending_info["disks"]["vda"]
+        assert pending_info["disks"]["vda"]["target"].endswith("_vda.qcow2")
 
     def take_snapshot_and_return_date(self, mock_domain, target_dir,
                                       monkeypatch):
@@ -128,6 +144,184 @@ class TestDomBackup():
         definition = dombkup.get_definition()
         return dombkup._snapshot_and_save_date(definition)
 
+    def test_backup_disks(self, build_mock_domain, mocker):
+        """
+        Backup all disks in parallel and clean their snapshot after
+        """
+        dombkup = build_dombackup(dom=build_mock_domain, max_workers=2)
+        dombkup._backup_disk = mocker.stub()
+        dombkup._ext_snapshot_helper = mocker.Mock()
+
+        dombkup._backup_disks("target", {})
+
+        assert dombkup._backup_disk.call_count == 2
+        cleaned_disks = sorted(
+            c[0][0] for c in
+            dombkup._ext_snapshot_helper.clean_for_disk.call_args_list
+        )
+        assert cleaned_disks == ["vda", "vdb"]
+
+    @pytest.mark.parametrize("compression", ("tar", None))
+    def test_backup_disks_interrupted(self, build_mock_domain, tmpdir,
+                                      mocker, compression):
+        """
+        Disks in a tar or with 1 worker are backed up in the calling thread
+
+        An interruption should then not wait for the next disks.
+        """
+        dombkup = build_dombackup(
+            dom=build_mock_domain, compression=compression,
+            max_workers=None if compression else 1
+        )
+        dombkup._ext_snapshot_helper = mocker.Mock()
+        backup_threads = []
+
+        def interrupted_backup_disk(*args, **kwargs):
+            backup_threads.append(threading.current_thread())
+            raise KeyboardInterrupt()
+
+        dombkup._backup_disk = mocker.Mock(
+            side_effect=interrupted_backup_disk
+        )
+        if compression:
+            target = tarfile.open(str(tmpdir.join("test.tar")), "w")
+        else:
+            target = str(tmpdir)
+
+        with pytest.raises(KeyboardInterrupt):
+            dombkup._backup_disks(target, {})
+        if compression:
+            target.close()
+
+        assert backup_threads == [threading.main_thread()]
+        assert dombkup._backup_disk.call_args[0][0] == "vda"
+        assert not dombkup._ext_snapshot_helper.clean_for_disk.called
+
+    def build_dombackup_to_start(self, mock_domain, tmpdir, mocker,
+                                 **dombackup_kwargs):
+        """
+        Build a DomBackup with real disk images and mocked external snapshots
+        """
+        img_dir = tmpdir.mkdir("images")
+        mock_domain.set_storage_basedir(str(img_dir))
+        dombkup = build_dombackup(
+            dom=mock_domain, target_dir=str(tmpdir.mkdir("backups")),
+            **dombackup_kwargs
+        )
+        for disk, prop in dombkup.disks.items():
+            with open(prop["src"], "w") as f:
+                f.write(disk)
+
+        mocker.patch.object(DomExtSnapshot, "start", return_value={
+            "date": arrow.now(),
+            "disks": {
+                disk: {"src": prop["src"], "snapshot": prop["src"] + ".snap"}
+                for disk, prop in dombkup.disks.items()
+            },
+        })
+        mocker.patch.object(DomExtSnapshot, "clean")
+        mocker.patch.object(DomExtSnapshot, "clean_for_disk")
+        return dombkup
+
+    def test_start(self, build_mock_domain, tmpdir, mocker):
+        dombkup = self.build_dombackup_to_start(
+            build_mock_domain, tmpdir, mocker, compression="tar"
+        )
+        dombkup.start()
+
+        backup_files = sorted(
+            f.basename for f in tmpdir.join("backups").listdir()
+        )
+        assert len(backup_files) == 2
+        assert backup_files[0].endswith(".json")
+        assert backup_files[1].endswith(".tar")
+
+    def test_start_compressor_error(self, build_mock_domain, tmpdir, mocker,
+                                    monkeypatch):
+        """
+        A failing compressor should abort the backup, without definition left
+        """
+        monkeypatch.setitem(
+            virt_backup.backups.pending._EXTERNAL_COMPRESSORS, "gz",
+            ("false", )
+        )
+        dombkup = self.build_dombackup_to_start(
+            build_mock_domain, tmpdir, mocker, compression="gz"
+        )
+
+        with pytest.raises(Exception):
+            dombkup.start()
+        assert not tmpdir.join("backups").listdir()
+
+    def test_backup_disks_without_disk(self, build_mock_domain, mocker):
+        dombkup = build_dombackup(dom=build_mock_domain)
+        dombkup.disks = {}
+        dombkup._backup_disk = mocker.stub()
+
+        dombkup._backup_disks("target", {})
+
+        assert not dombkup._backup_disk.called
+
+    def test_start_cancelled_between_disks(self, build_mock_domain, tmpdir,
+                                           mocker):
+        """
+        A cancelled backup should stop before its next disk and be cleaned
+        """
+        dombkup = self.build_dombackup_to_start(
+            build_mock_domain, tmpdir, mocker, compression=None, max_workers=1
+        )
+        cancel_event = threading.Event()
+        backup_img = dombkup.backup_img
+
+        def backup_img_then_cancel(*args, **kwargs):
+            cancel_event.set()
+            return backup_img(*args, **kwargs)
+
+        dombkup.backup_img = mocker.Mock(side_effect=backup_img_then_cancel)
+        mocker.spy(dombkup, "clean_aborted")
+
+        with pytest.raises(BackupCancelledError):
+            dombkup.start(cancel_event=cancel_event)
+
+        assert dombkup.backup_img.call_count == 1
+        assert dombkup.clean_aborted.called
+        assert not tmpdir.join("backups").listdir()
+
+    def test_start_cancelled_with_parallel_disks(self, build_mock_domain,
+                                                 tmpdir, mocker, monkeypatch):
+        """
+        Disks already started should not be copied once the backup is
+        cancelled
+        """
+        monkeypatch.setattr(
+            "virt_backup.backups.pending._DEFAULT_MAX_DISK_WORKERS", 2
+        )
+        dombkup = self.build_dombackup_to_start(
+            build_mock_domain, tmpdir, mocker, compression=None
+        )
+        assert dombkup.max_workers is None and len(dombkup.disks) == 2
+        cancel_event = threading.Event()
+        started = threading.Barrier(2, timeout=5)
+        disk_target_name = dombkup._disk_target_name
+
+        def disk_target_name_then_cancel(*args, **kwargs):
+            # also called by the main thread when saving the pending info
+            if threading.current_thread() is not threading.main_thread():
+                # both disks are started, cancel the backup before their copy
+                if started.wait() == 0:
+                    cancel_event.set()
+                started.wait()
+            return disk_target_name(*args, **kwargs)
+
+        dombkup._disk_target_name = disk_target_name_then_cancel
+        mocker.spy(dombkup, "backup_img")
+
+        with pytest.raises(BackupCancelledError):
+            dombkup.start(cancel_event=cancel_event)
+
+        assert not dombkup.backup_img.called
+        assert not tmpdir.join("backups").listdir()
+
     def test_main_backup_name_format(self, get_dombackup):
         dombkup = get_dombackup
         snapdate = datetime.datetime(2016, 8, 15, 17, 10, 13, 0)
@@ -135,6 +329,15 @@ class TestDomBackup():
         expected_name = "20160815-171013_1_test"
         assert dombkup._main_backup_name_format(snapdate) == expected_name
 
+    def test_main_backup_name_format_timestamp(self, get_dombackup):
+        dombkup = get_dombackup
+        snapdate = datetime.datetime(2016, 8, 15, 17, 10, 13, 0)
+
+        expected_name = "20160815-171013_1_test"
+        assert dombkup._main_backup_name_format(
+            snapdate.timestamp()
+        ) == expected_name
+
     def test_disk_backup_name_format(self, get_dombackup):
         dombkup = get_dombackup
         snapdate = datetime.datetime(2016, 8, 15, 17, 10, 13, 0)
@@ -168,6 +371,51 @@ class TestDomBackup():
             build_mock_domain, tmpdir, compression="xz"
         )
 
+    def test_get_new_tar_piped(self, build_mock_domain, tmpdir, monkeypatch):
+        """
+        Use gzip as external compressor, and check the tar is readable
+        """
+        monkeypatch.setitem(
+            virt_backup.backups.pending._EXTERNAL_COMPRESSORS, "gz",
+            ("gzip", )
+        )
+        dombkup = build_dombackup(
+            dom=build_mock_domain, compression="gz", compression_lvl=6
+        )
+        snapdate = datetime.datetime(2016, 8, 15, 17, 10, 13, 0)
+        img = tmpdir.join("vda.qcow2")
+        img.write("test")
+
+        with dombkup.get_new_tar(str(tmpdir), snapshot_date=snapdate) as tar:
+            assert tar.compressor
+            tar.add(str(img), arcname="vda.qcow2")
+            tar_path = tar.name
+
+        with tarfile.open(tar_path, "r:gz") as tar:
+            assert tar.getnames() == ["vda.qcow2"]
+
+    def test_get_new_tar_piped_compressor_error(self, build_mock_domain,
+                                                tmpdir, monkeypatch):
+        """
+        Closing the tar should wait for a failing compressor and report it
+        """
+        monkeypatch.setitem(
+            virt_backup.backups.pending._EXTERNAL_COMPRESSORS, "gz",
+            ("false", )
+        )
+        dombkup = build_dombackup(dom=build_mock_domain, compression="gz")
+        snapdate = datetime.datetime(2016, 8, 15, 17, 10, 13, 0)
+        img = tmpdir.join("vda.qcow2")
+        img.write("test")
+
+        tar = dombkup.get_new_tar(str(tmpdir), snapshot_date=snapdate)
+        tar.add(str(img), arcname="vda.qcow2")
+        # the buffered tar will be flushed to a closed pipe
+        tar.compressor.wait()
+        with pytest.raises(subprocess.CalledProcessError):
+            tar.close()
+        assert tar.compressor.returncode == 1
+
     def test_get_new_tar_already_exists(self, build_mock_domain, tmpdir):
         dombkup = build_dombackup(dom=build_mock_domain, compression="tar")
 
@@ -4,7 +4,7 @@ import arrow
 import pytest
 
 from virt_backup.backups import DomBackup
-from virt_backup.domains import get_xml_block_of_disk
+from virt_backup.domains import get_xml_block_of_disk, parse_libvirt_xml
 from virt_backup.backups.snapshot import (
     DomExtSnapshot, DomExtSnapshotCallbackRegistrer
 )
@@ -90,6 +90,17 @@ class TestDomExtSnapshot():
         )
         assert self.snapshot_helper.gen_libvirt_snapshot_xml() == expected_xml
 
+    def test_get_libvirt_snapshot_xml_parsed_dom_xml(self, mocker):
+        """
+        A parsed domain XML given to the helper should be used as it is
+        """
+        dom = self.snapshot_helper.dom
+        self.snapshot_helper._dom_xml = parse_libvirt_xml(dom.XMLDesc())
+        mocker.spy(dom, "XMLDesc")
+
+        assert "vdb" in self.snapshot_helper.gen_libvirt_snapshot_xml()
+        assert not dom.XMLDesc.called
+
     def test_get_libvirt_snapshot_xml_ignored_disk(self):
         self.snapshot_helper.disks.pop("vdb")
         expected_xml = (
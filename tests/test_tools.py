@@ -0,0 +1,171 @@
+import errno
+import json
+import os
+import tarfile
+import pytest
+
+import virt_backup.tools
+from virt_backup.tools import (
+    add_file_to_tar, copy_file, dump_json, ensure_dir, positive_int_from_env
+)
+
+
+@pytest.fixture
+def disk_img(tmpdir):
+    """
+    Disk image of a few KiB, not aligned on the tar blocks
+    """
+    img = tmpdir.join("vda.qcow2")
+    img.write_binary(os.urandom(4096 + 42))
+    return img
+
+
+@pytest.mark.parametrize("mode", ("w", "w:gz", "w:xz"))
+def test_add_file_to_tar(tmpdir, disk_img, mode):
+    img, img_content = disk_img, disk_img.read_binary()
+
+    tar_path = str(tmpdir.join("test.tar"))
+    with tarfile.open(tar_path, mode) as tar:
+        add_file_to_tar(tar, str(img), "vda.qcow2")
+        tar.add(str(img), arcname="vdb.qcow2")
+
+    with tarfile.open(tar_path, "r:*") as tar:
+        assert tar.getnames() == ["vda.qcow2", "vdb.qcow2"]
+        assert tar.extractfile("vda.qcow2").read() == img_content
+        assert tar.extractfile("vdb.qcow2").read() == img_content
+
+
+def test_add_file_to_tar_sendfile_unsupported(tmpdir, disk_img,
+                                              monkeypatch):
+    """
+    Finish the copy in userspace when sendfile stops being supported
+    """
+    img, img_content = disk_img, disk_img.read_binary()
+    sendfile = os.sendfile
+
+    def sendfile_once(out_fd, in_fd, offset, count):
+        if offset:
+            raise OSError(errno.EINVAL, "sendfile not supported")
+        return sendfile(out_fd, in_fd, offset, 1024)
+
+    monkeypatch.setattr(virt_backup.tools, "_USE_SENDFILE", True)
+    monkeypatch.setattr(virt_backup.tools.os, "sendfile", sendfile_once)
+    tar_path = str(tmpdir.join("test.tar"))
+    with tarfile.open(tar_path, "w") as tar:
+        add_file_to_tar(tar, str(img), "vda.qcow2")
+
+    with tarfile.open(tar_path, "r") as tar:
+        assert tar.extractfile("vda.qcow2").read() == img_content
+
+
+def test_copy_file(tmpdir, disk_img):
+    src, src_content = disk_img, disk_img.read_binary()
+
+    dst = copy_file(str(src), str(tmpdir.join("backup")) + "/")
+
+    assert dst == str(tmpdir.join("backup", "vda.qcow2"))
+    with open(dst, "rb") as f:
+        assert f.read() == src_content
+
+
+def test_copy_file_preallocate(tmpdir, disk_img):
+    dst = copy_file(
+        str(disk_img), str(tmpdir.join("vda.qcow2.bak")), preallocate=True
+    )
+
+    with open(dst, "rb") as f:
+        assert f.read() == disk_img.read_binary()
+
+
+def test_copy_file_in_existing_dir(tmpdir, disk_img):
+    backup_dir = tmpdir.mkdir("backup")
+
+    dst = copy_file(str(disk_img), str(backup_dir))
+
+    assert dst == str(backup_dir.join("vda.qcow2"))
+    assert backup_dir.join("vda.qcow2").read_binary() == (
+        disk_img.read_binary()
+    )
+
+
+def test_copy_file_range_copying_nothing(tmpdir, disk_img, monkeypatch):
+    """
+    copy_file_range returning 0 on a non empty file should not be trusted
+    """
+    monkeypatch.setattr(virt_backup.tools, "_HAS_COPY_FILE_RANGE", True)
+    monkeypatch.setattr(
+        virt_backup.tools.os, "copy_file_range", lambda *args: 0,
+        raising=False
+    )
+    monkeypatch.setattr(virt_backup.tools, "_reflink", lambda *args: False)
+
+    dst = copy_file(str(disk_img), str(tmpdir.join("vda.qcow2.bak")))
+
+    with open(dst, "rb") as f:
+        assert f.read() == disk_img.read_binary()
+
+
+def test_copy_file_sendfile(tmpdir, disk_img, monkeypatch):
+    """
+    Copy with sendfile when reflink and copy_file_range are not supported
+    """
+    monkeypatch.setattr(virt_backup.tools, "_reflink", lambda *args: False)
+    monkeypatch.setattr(
+        virt_backup.tools, "_copy_file_range", lambda *args: False
+    )
+    src, src_content = disk_img, disk_img.read_binary()
+
+    dst = copy_file(str(src), str(tmpdir.join("vda.qcow2.bak")))
+
+    with open(dst, "rb") as f:
+        assert f.read() == src_content
+
+
+def test_copy_file_userspace(tmpdir, disk_img, monkeypatch):
+    """
+    Copy by chunks when no kernel space copy is supported
+    """
+    monkeypatch.setattr(
+        virt_backup.tools, "_copy_file_range", lambda *args: False
+    )
+    src, src_content = disk_img, disk_img.read_binary()
+
+    dst = copy_file(
+        str(src), str(tmpdir.join("vda.qcow2.bak")), buffersize=4096,
+        try_reflink=False, use_sendfile=False
+    )
+
+    with open(dst, "rb") as f:
+        assert f.read() == src_content
+
+
+def test_ensure_dir(tmpdir):
+    path = str(tmpdir.join("a", "b"))
+
+    assert ensure_dir(path)
+    assert os.path.isdir(path)
+    assert not ensure_dir(path)
+
+
+def test_dump_json(tmpdir):
+    obj = {"domain_name": "test", "disks": {"vda": "vda.qcow2"}, "date": 1.5}
+    json_path = tmpdir.join("test.json")
+
+    dump_json(obj, str(json_path))
+
+    assert tmpdir.listdir() == [json_path]
+    assert json.loads(json_path.read()) == obj
+
+
+@pytest.mark.parametrize("value", ("two", "0", "-4096"))
+def test_positive_int_from_env_invalid(monkeypatch, value):
+    monkeypatch.setenv("VIRT_BACKUP_TEST", value)
+    assert positive_int_from_env("VIRT_BACKUP_TEST", 42) == 42
+
+
+def test_positive_int_from_env(monkeypatch):
+    monkeypatch.delenv("VIRT_BACKUP_TEST", raising=False)
+    assert positive_int_from_env("VIRT_BACKUP_TEST", 42) == 42
+
+    monkeypatch.setenv("VIRT_BACKUP_TEST", "4096")
+    assert positive_int_from_env("VIRT_BACKUP_TEST", 42) == 4096
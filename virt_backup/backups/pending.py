@@ -1,22 +1,42 @@
-import arrow
-import defusedxml.lxml
-import json
+import concurrent.futures
 import libvirt
 import logging
 import lxml.etree
 import os
+import shutil
 import subprocess
 import tarfile
+import threading
+import time
 
 import virt_backup
-from virt_backup.domains import get_xml_block_of_disk
-from virt_backup.tools import copy_file
+from virt_backup.domains import parse_libvirt_xml
+from virt_backup.exceptions import BackupCancelledError
+from virt_backup.tools import (
+    DEFAULT_COPY_BUFSIZE, add_file_to_tar, copy_file, dump_json, ensure_dir,
+    positive_int_from_env
+)
 from . import _BaseDomBackup
 from .snapshot import DomExtSnapshot
 
 
 logger = logging.getLogger("virt_backup")
 
+#: external compressors used instead of tarfile when installed, by order of
+#  preference. Even the single threaded ones compress out of the python
+#  process, so parallel backups are not limited by the GIL.
+_EXTERNAL_COMPRESSORS = {
+    "gz": ("pigz", "gzip"),
+    "bz2": ("pbzip2", "bzip2"),
+    "xz": ("pixz", "xz"),
+}
+
+#: default limit of disks backup in parallel by domain, when max_workers is
+#  not set. Can be lowered to not oversubscribe a single disk storage.
+_DEFAULT_MAX_DISK_WORKERS = positive_int_from_env(
+    "VIRT_BACKUP_MAX_DISK_WORKERS", os.cpu_count() or 1
+)
+
 
 def build_dom_backup_from_pending_info(
         pending_info, backup_dir, conn, callbacks_registrer
@@ -34,13 +54,43 @@ def build_dom_backup_from_pending_info(
     return backup
 
 
+class _PipedTarFile(tarfile.TarFile):
+    """
+    Tar streamed to an external compressor
+
+    Closing the tar waits for the compressor to end.
+    """
+
+    #: compressor process, as subprocess.Popen
+    compressor = None
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            super().close()
+        finally:
+            try:
+                self.compressor.stdin.close()
+            except BrokenPipeError:
+                # the compressor exited early, its return code tells why
+                pass
+            returncode = self.compressor.wait()
+            if returncode:
+                raise subprocess.CalledProcessError(
+                    returncode, self.compressor.args
+                )
+
+
 class DomBackup(_BaseDomBackup):
     """
     Libvirt domain backup
     """
     def __init__(self, dom, target_dir=None, dev_disks=None, compression="tar",
                  compression_lvl=None, conn=None, timeout=None, disks=None,
-                 ext_snapshot_helper=None, callbacks_registrer=None):
+                 ext_snapshot_helper=None, callbacks_registrer=None,
+                 max_workers=None):
         """
         :param dev_disks: list of disks dev names to backup. Disks will be
                           searched in the domain to pull more informations, and
@@ -49,10 +99,24 @@ class DomBackup(_BaseDomBackup):
         :param disks: dictionary of disks to backup, in this form:
                       `{"src": disk_path, "type": disk_format}`. Prefer
                       using dev disks when possible.
+        :param max_workers: maximum number of disks to backup in parallel. If
+                            None, will use the number of disks, limited by
+                            the number of CPUs, or by the
+                            VIRT_BACKUP_MAX_DISK_WORKERS environment
+                            variable if set.
         """
         #: domain to backup. Has to be a libvirt.virDomain object
         self.dom = dom
 
+        #: domain name, ID and XML, cached as each call is a libvirt RPC.
+        #  Refreshed when the backup starts.
+        self._dom_name = None
+        self._dom_id = None
+        self._dom_xml = None
+        #: parsed self._dom_xml, kept until the XML is refreshed
+        self._dom_xml_tree = None
+        self._cache_dom_infos()
+
         #: directory where backups will be saved
         self.target_dir = target_dir
 
@@ -84,6 +148,9 @@ class DomBackup(_BaseDomBackup):
         #  timeout is None
         self.timeout = timeout
 
+        #: maximum number of disks to backup in parallel
+        self.max_workers = max_workers
+
         #: droppable helper to take and clean external snapshots. Can be
         #  construct with an ext_snapshot_helper to clean the snapshots of an
         #  aborted backup. Starting a backup will erase this helper.
@@ -103,9 +170,22 @@ class DomBackup(_BaseDomBackup):
         #  the backup if anything goes wrong
         self.pending_info = {}
 
+        #: pending_info changed since its last dump
+        self._pending_info_dirty = False
+
         #: Used as lock when the backup is already running
         self._running = False
 
+        #: threading.Event set to cancel the running backup
+        self._cancel_event = None
+
+        #: protect pending_info and the backup definition, as disks are backup
+        #  in parallel
+        self._pending_info_lock = threading.Lock()
+
+        #: tarfile.TarFile is not thread-safe, protect the shared tar
+        self._tar_lock = threading.Lock()
+
     @property
     def running(self):
         return self._running
@@ -126,59 +206,96 @@ class DomBackup(_BaseDomBackup):
         :param dev_disk: dev name of the new disk to backup. If not indicated,
                          will add all disks.
         """
+        missing_disks = [dev for dev in dev_disks if dev not in self.disks]
+        if dev_disks and not missing_disks:
+            # nothing to add, avoid to pull and parse the domain XML
+            return
+
+        self._refresh_dom_xml()
         dom_all_disks = self._get_self_domain_disks()
         if not dev_disks:
             self.disks = dom_all_disks
-        for dev in dev_disks:
-            if dev in self.disks:
-                continue
+        for dev in missing_disks:
             self.disks[dev] = dom_all_disks[dev]
 
-    def start(self):
+    def start(self, cancel_event=None):
         """
         Start the entire backup process for all disks in self.disks
+
+        :param cancel_event: threading.Event. When set, the disks not already
+                             copied are not backup, and the backup is
+                             aborted.
         """
         assert not self.running
         assert self.dom and self.target_dir
 
+        self._cache_dom_infos()
         backup_target = None
-        logger.info("%s: Backup started", self.dom.name())
+        logger.info("%s: Backup started", self._dom_name)
         definition = self.get_definition()
         definition["disks"] = {}
 
-        if not os.path.exists(self.target_dir):
-            logger.debug("%s: create dir %s", self.dom.name(), self.target_dir)
-            os.mkdir(self.target_dir)
+        if ensure_dir(self.target_dir):
+            logger.debug("%s: create dir %s", self._dom_name, self.target_dir)
         try:
             self._running = True
+            self._cancel_event = cancel_event
             self._ext_snapshot_helper = DomExtSnapshot(
                 self.dom, self.disks, self._callbacks_registrer, self.conn,
-                self.timeout
+                self.timeout, dom_xml=self._parse_dom_xml()
             )
 
             snapshot_date, definition = (
                 self._snapshot_and_save_date(definition)
             )
 
-            backup_target = (
-                self.target_dir if self.compression is None
-                else self.get_new_tar(self.target_dir, snapshot_date)
-            )
+            if self.compression is None:
+                backup_target = self.target_dir
+            else:
+                backup_target = self.get_new_tar(
+                    self.target_dir, snapshot_date
+                )
+                self._set_pending_tar(backup_target)
 
             # TODO: handle backingStore cases
-            for disk, prop in self.disks.items():
-                self._backup_disk(disk, prop, backup_target, definition)
-                self._ext_snapshot_helper.clean_for_disk(disk)
+            self._backup_disks(backup_target, definition)
 
+            if isinstance(backup_target, tarfile.TarFile):
+                # compressor errors are only raised when closing the tar,
+                # which has then to be done before validating the backup by
+                # dumping its definition
+                backup_target.close()
             self._dump_json_definition(definition)
             self.post_backup(backup_target)
             self._clean_pending_info()
         except:
+            if isinstance(backup_target, tarfile.TarFile):
+                # release the tar, and its compressor, before deleting it
+                try:
+                    backup_target.close()
+                except Exception as e:
+                    logger.error("Error closing aborted tar: %s", e)
             self.clean_aborted()
             raise
         finally:
             self._running = False
-        logger.info("%s: Backup finished", self.dom.name())
+            self._cancel_event = None
+        logger.info("%s: Backup finished", self._dom_name)
+
+    def _cache_dom_infos(self):
+        """
+        Cache the domain name, ID and XML
+
+        Each of these calls is a libvirt RPC, they are then cached instead of
+        being called for each disk or log.
+        """
+        self._dom_name = self.dom.name()
+        self._dom_id = self.dom.ID()
+        self._refresh_dom_xml()
+
+    def _refresh_dom_xml(self):
+        self._dom_xml = self.dom.XMLDesc()
+        self._dom_xml_tree = None
 
     def _snapshot_and_save_date(self, definition):
         """
@@ -195,26 +312,35 @@ class DomBackup(_BaseDomBackup):
         # all of our disks are snapshot, so the backup date is right now
         definition["date"] = snapshot_metadatas["date"].timestamp
 
+        # targets are known from now, so store them directly: the pending
+        # info will not have to be dumped again before each disk backup
         self.pending_info = definition.copy()
         self.pending_info["disks"] = {
             disk: {
                 "src": prop["src"],
-                "snapshot": snapshot_metadatas["disks"][disk]["snapshot"]
+                "snapshot": snapshot_metadatas["disks"][disk]["snapshot"],
+                "target": self._disk_target_name(
+                    definition["date"], disk, prop["type"]
+                ),
             } for disk, prop in self.disks.items()
         }
-        self._dump_pending_info()
+        self._pending_info_dirty = True
+        self._flush_pending_info_if_dirty()
 
         return snapshot_metadatas["date"], definition
 
     def get_definition(self):
         """
         Get a json defining this backup
+
+        The domain XML is the one cached at the last refresh (done when the
+        backup starts), to avoid another libvirt call.
         """
         return {
             "compression": self.compression,
             "compression_lvl": self.compression_lvl,
-            "domain_id": self.dom.ID(), "domain_name": self.dom.name(),
-            "domain_xml": self.dom.XMLDesc(), "version": virt_backup.VERSION
+            "domain_id": self._dom_id, "domain_name": self._dom_name,
+            "domain_xml": self._dom_xml, "version": virt_backup.VERSION
         }
 
     def get_new_tar(self, target, snapshot_date):
@@ -227,19 +353,19 @@ class DomBackup(_BaseDomBackup):
                        will be created.
         """
         extra_args = {}
+        # exclusive creation, raise FileExistsError if the tar already exists
         if self.compression not in (None, "tar"):
-            mode = "w:{}".format(self.compression)
+            mode = "x:{}".format(self.compression)
             extension = "tar.{}".format(self.compression)
             if self.compression == "xz":
                 extra_args["preset"] = self.compression_lvl
             else:
                 extra_args["compresslevel"] = self.compression_lvl
         else:
-            mode = "w"
+            mode = "x"
             extension = "tar"
 
-        if not os.path.isdir(target):
-            os.makedirs(target)
+        ensure_dir(target)
 
         complete_path = os.path.join(
             target,
@@ -247,10 +373,95 @@ class DomBackup(_BaseDomBackup):
                 self._main_backup_name_format(snapshot_date), extension
             )
         )
-        if os.path.exists(complete_path):
-            raise FileExistsError()
+
+        compressor = self._find_external_compressor()
+        if compressor:
+            return self._get_new_piped_tar(complete_path, compressor)
         return tarfile.open(complete_path, mode, **extra_args)
 
+    def _find_external_compressor(self):
+        """
+        :returns: first external compressor installed for self.compression,
+                  or None
+        """
+        for compressor in _EXTERNAL_COMPRESSORS.get(self.compression, ()):
+            if shutil.which(compressor):
+                return compressor
+        return None
+
+    def _get_new_piped_tar(self, complete_path, compressor):
+        """
+        Get a new tar streamed to an external compressor
+
+        The compression is then done out of the python process, and with
+        multiple threads if the tool supports it.
+
+        :param complete_path: path of the compressed tar to create
+        :param compressor: compressor binary, reading the tar on its stdin
+        """
+        cmd = [compressor]
+        if self.compression_lvl is not None:
+            cmd.append("-{}".format(self.compression_lvl))
+
+        logger.debug("%s: compress tar with %s", self._dom_name, compressor)
+        with open(complete_path, "xb") as compressed_tar:
+            proc = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=compressed_tar,
+                bufsize=DEFAULT_COPY_BUFSIZE
+            )
+        # the default tarfile stream buffer (10 KiB) splits each copied chunk
+        # in many small writes, each copying the rest of the buffer
+        tar = _PipedTarFile.open(
+            complete_path, "w|", fileobj=proc.stdin,
+            bufsize=DEFAULT_COPY_BUFSIZE
+        )
+        tar.compressor = proc
+
+        return tar
+
+    def _backup_disks(self, backup_target, definition):
+        """
+        Backup all disks
+
+        Disks are copied in parallel only when they are not compressed: disks
+        added to a tar are written one after the other anyway, so they are
+        backed up in the calling thread, which keeps them interruptible.
+
+        The external snapshot of a disk is cleaned as soon as its backup is
+        done.
+
+        :param backup_target: target path of our backup
+        :param definition: dictionary representing the domain backup
+        """
+        if not self.disks:
+            return
+
+        max_workers = self.max_workers or min(
+            len(self.disks), _DEFAULT_MAX_DISK_WORKERS
+        )
+        if isinstance(backup_target, tarfile.TarFile) or max_workers == 1:
+            for disk, prop in self.disks.items():
+                self._backup_disk(disk, prop, backup_target, definition)
+                self._ext_snapshot_helper.clean_for_disk(disk)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            futures = {
+                executor.submit(
+                    self._backup_disk, disk, prop, backup_target, definition
+                ): disk for disk, prop in self.disks.items()
+            }
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+                    self._ext_snapshot_helper.clean_for_disk(futures[future])
+            except:
+                # do not start the disks still waiting, the executor will
+                # wait for the running ones before leaving
+                for future in futures:
+                    future.cancel()
+                raise
+
     def _backup_disk(self, disk, disk_properties, backup_target, definition):
         """
         Backup a disk and complete the definition by adding this disk
@@ -261,27 +472,52 @@ class DomBackup(_BaseDomBackup):
         :param backup_target: target path of our backup
         :param definition: dictionary representing the domain backup
         """
-        snapshot_date = arrow.get(definition["date"]).to("local")
-        logger.info("%s: Backup disk %s", self.dom.name(), disk)
-        target_img = "{}.{}".format(
-            self._disk_backup_name_format(snapshot_date, disk),
-            disk_properties["type"]
-        )
-        self.pending_info["disks"][disk]["target"] = target_img
-        self._dump_pending_info()
-
-        if definition.get("disks", None) is None:
-            definition["disks"] = {}
-        definition["disks"][disk] = target_img
+        self._raise_if_cancelled()
 
+        logger.info("%s: Backup disk %s", self._dom_name, disk)
+        target_img = self._disk_target_name(
+            definition["date"], disk, disk_properties["type"]
+        )
+        with self._pending_info_lock:
+            disk_pending_info = self.pending_info["disks"][disk]
+            if disk_pending_info.get("target", None) != target_img:
+                disk_pending_info["target"] = target_img
+                self._pending_info_dirty = True
+            # the target has to be dumped before being written, to be cleaned
+            # if the backup is aborted. Already done by
+            # _snapshot_and_save_date in most cases.
+            self._flush_pending_info_if_dirty()
+
+            if definition.get("disks", None) is None:
+                definition["disks"] = {}
+            definition["disks"][disk] = target_img
+
+        # the other disks could have failed since this one started
+        self._raise_if_cancelled()
         backup_path = self.backup_img(
             disk_properties["src"], backup_target, target_img
         )
         if self.compression:
-            if not definition.get("tar", None):
-                # all disks will be compacted in the same tar, so already
-                # store it in definition if it was not set before
-                definition["tar"] = os.path.basename(backup_path)
+            with self._pending_info_lock:
+                if not definition.get("tar", None):
+                    # all disks will be compacted in the same tar, so already
+                    # store it in definition if it was not set before
+                    definition["tar"] = os.path.basename(backup_path)
+
+    def _raise_if_cancelled(self):
+        """
+        :raises BackupCancelledError: if the running backup is cancelled
+        """
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            raise BackupCancelledError(self._dom_name)
+
+    def _disk_target_name(self, snapdate, disk_name, disk_type):
+        """
+        Complete filename of the backup of a disk, with its extension
+        """
+        return "{}.{}".format(
+            self._disk_backup_name_format(snapdate, disk_name), disk_type
+        )
 
     def _disk_backup_name_format(self, snapdate, disk_name, *args, **kwargs):
         """
@@ -313,7 +549,7 @@ class DomBackup(_BaseDomBackup):
         else:
             backup_path = self._copy_img_to_file(disk, target, target_filename)
 
-        logger.debug("%s: %s successfully copied", self.dom.name(), disk)
+        logger.debug("%s: %s successfully copied", self._dom_name, disk)
         return os.path.abspath(backup_path)
 
     def _add_img_to_tarfile(self, img, target, target_filename):
@@ -322,18 +558,29 @@ class DomBackup(_BaseDomBackup):
         :param target: tarfile.TarFile where img will be added
         :param target_filename: img name in the tarfile
         """
-        logger.debug("%s: Copy %s", self.dom.name(), img)
-        if self.compression == "xz":
-            backup_path = target.fileobj._fp.name
-        else:
-            backup_path = target.fileobj.name
-        self.pending_info["tar"] = os.path.basename(backup_path)
-        self._dump_pending_info()
+        logger.debug("%s: Copy %s", self._dom_name, img)
+        backup_path = target.name
+        self._set_pending_tar(target)
 
-        target.add(img, arcname=target_filename)
+        with self._tar_lock:
+            # the backup could have been cancelled while waiting for the lock
+            self._raise_if_cancelled()
+            add_file_to_tar(target, img, target_filename)
 
         return backup_path
 
+    def _set_pending_tar(self, tar):
+        """
+        Store the tar used for this backup in the pending info, and dump them
+        if the tar was not known yet
+        """
+        with self._pending_info_lock:
+            tar_name = os.path.basename(tar.name)
+            if self.pending_info.get("tar", None) != tar_name:
+                self.pending_info["tar"] = tar_name
+                self._pending_info_dirty = True
+            self._flush_pending_info_if_dirty()
+
     def _copy_img_to_file(self, img, target, target_filename=None):
         """
         :param img: source img path
@@ -342,10 +589,9 @@ class DomBackup(_BaseDomBackup):
         :param target_filename: name of the img copy
         """
         if target_filename is not None:
-            if not os.path.isdir(target):
-                os.makedirs(target)
+            ensure_dir(target)
         target = os.path.join(target, target_filename or img)
-        logger.debug("%s: Copy %s as %s", self.dom.name(), img, target)
+        logger.debug("%s: Copy %s as %s", self._dom_name, img, target)
         copy_file(img, target)
 
         return target
@@ -366,8 +612,13 @@ class DomBackup(_BaseDomBackup):
     def _parse_dom_xml(self):
         """
         Parse the domain's definition
+
+        The parsed XML is cached until the XML is refreshed, and should not be
+        modified.
         """
-        return defusedxml.lxml.fromstring(self.dom.XMLDesc())
+        if self._dom_xml_tree is None:
+            self._dom_xml_tree = parse_libvirt_xml(self._dom_xml)
+        return self._dom_xml_tree
 
     def _dump_json_definition(self, definition):
         """
@@ -376,34 +627,39 @@ class DomBackup(_BaseDomBackup):
         Definition will describe our backup, with the date, backuped
         disks names and other informations
         """
-        backup_date = arrow.get(definition["date"]).to("local")
         definition_path = os.path.join(
             self.target_dir,
-            "{}.{}".format(self._main_backup_name_format(backup_date), "json")
+            "{}.{}".format(
+                self._main_backup_name_format(definition["date"]), "json"
+            )
         )
-        with open(definition_path, "w") as json_definition:
-            json.dump(definition, json_definition, indent=4)
+        dump_json(definition, definition_path)
+
+    def _flush_pending_info_if_dirty(self):
+        """
+        Dump the pending info only if they changed since the last dump
+        """
+        if self._pending_info_dirty:
+            self._dump_pending_info()
 
     def _dump_pending_info(self):
         """
         Dump the temporary changes done, as json
-
-        Useful
         """
-        json_path = self._get_pending_info_json_path()
-        with open(json_path, "w") as json_pending_info:
-            json.dump(self.pending_info, json_pending_info, indent=4)
+        dump_json(self.pending_info, self._get_pending_info_json_path())
+        self._pending_info_dirty = False
 
     def _clean_pending_info(self):
         os.remove(self._get_pending_info_json_path())
         self.pending_info = {}
+        self._pending_info_dirty = False
 
     def _get_pending_info_json_path(self):
-        backup_date = arrow.get(self.pending_info["date"]).to("local")
         json_path = os.path.join(
             self.target_dir,
             "{}.{}.pending".format(
-                self._main_backup_name_format(backup_date), "json"
+                self._main_backup_name_format(self.pending_info["date"]),
+                "json"
             )
         )
         return json_path
@@ -414,10 +670,18 @@ class DomBackup(_BaseDomBackup):
 
         Extracted in its own function so it can be easily override
 
-        :param snapdate: date when external snapshots have been created
+        :param snapdate: date when external snapshots have been created, as a
+                         datetime or a timestamp
         """
-        str_snapdate = snapdate.strftime("%Y%m%d-%H%M%S")
-        return "{}_{}_{}".format(str_snapdate, self.dom.ID(), self.dom.name())
+        if isinstance(snapdate, (int, float)):
+            # avoid building an arrow object, which resolves the local
+            # timezone at each call
+            str_snapdate = time.strftime(
+                "%Y%m%d-%H%M%S", time.localtime(snapdate)
+            )
+        else:
+            str_snapdate = snapdate.strftime("%Y%m%d-%H%M%S")
+        return "{}_{}_{}".format(str_snapdate, self._dom_id, self._dom_name)
 
     def clean_aborted(self):
         is_ext_snap_helper_needed = (
@@ -455,12 +719,21 @@ class DomBackup(_BaseDomBackup):
             self._delete_with_error_printing(tar_path)
 
     def _clean_aborted_non_tar_img(self):
-        for disk in self.pending_info.get("disks", {}).values():
-            if not disk.get("target", None):
-                continue
-            target_path = self.get_complete_path_of(disk["target"])
-            if os.path.exists(target_path):
-                self._delete_with_error_printing(target_path)
+        targets = set(
+            disk["target"]
+            for disk in self.pending_info.get("disks", {}).values()
+            if disk.get("target", None)
+        )
+        if not targets:
+            return
+
+        # list the directory once instead of checking each target
+        try:
+            existing_files = set(e.name for e in os.scandir(self.target_dir))
+        except FileNotFoundError:
+            return
+        for target in targets.intersection(existing_files):
+            self._delete_with_error_printing(target)
 
     def compatible_with(self, dombackup):
         """
@@ -470,18 +743,19 @@ class DomBackup(_BaseDomBackup):
         compression and compression_lvl, self and dombackup are considered
         compatibles.
         """
-        def same_dombackup_and_self_attr(attr):
-            return getattr(self, attr) == getattr(dombackup, attr)
+        return self._compat_key == dombackup._compat_key
 
-        attributes_to_compare = (
-            "target_dir", "compression", "compression_lvl"
-        )
-        for a in attributes_to_compare:
-            if not same_dombackup_and_self_attr(a):
-                return False
+    @property
+    def _compat_key(self):
+        """
+        Properties that have to be equal for 2 backups to be compatible
 
-        same_domain = dombackup.dom.ID() == self.dom.ID()
-        return same_domain
+        Not cached, as the target and compression can be changed after init.
+        """
+        return (
+            self.target_dir, self.compression, self.compression_lvl,
+            self._dom_id
+        )
 
     def merge_with(self, dombackup):
         self.add_disks(*dombackup.disks.keys())
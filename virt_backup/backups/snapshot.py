@@ -3,12 +3,14 @@ import logging
 import os
 import subprocess
 import threading
+from xml.sax.saxutils import quoteattr
 import arrow
-import defusedxml.lxml
 import libvirt
 import lxml.etree
 
-from virt_backup.domains import get_domain_disks_of, get_xml_block_of_disk
+from virt_backup.domains import (
+    get_domain_disks_of, get_xml_block_of_disk, parse_libvirt_xml
+)
 from virt_backup.exceptions import DiskNotSnapshot, SnapshotNotStarted
 
 
@@ -65,7 +67,7 @@ class DomExtSnapshot():
     metadatas = None
 
     def __init__(self, dom, disks, callbacks_registrer, conn=None,
-                 timeout=None):
+                 timeout=None, dom_xml=None):
         #: domain to snapshot. Has to be a libvirt.virDomain object
         self.dom = dom
 
@@ -84,6 +86,11 @@ class DomExtSnapshot():
         #: used to trigger when block pivot ends, by snapshot path
         self._wait_for_pivot = defaultdict(threading.Event)
 
+        #: parsed domain XML, if already known, to generate the snapshot XML
+        #  without pulling the domain definition again. Only used before the
+        #  snapshot, as it changes the domain disks.
+        self._dom_xml = dom_xml
+
     def start(self):
         """
         Start the external snapshot
@@ -122,32 +129,31 @@ class DomExtSnapshot():
     def gen_libvirt_snapshot_xml(self):
         """
         Generate a xml defining the snapshot
-        """
-        root_el = lxml.etree.Element("domainsnapshot")
-        xml_tree = root_el.getroottree()
-
-        descr_el = lxml.etree.Element("description")
-        root_el.append(descr_el)
-        descr_el.text = "Pre-backup external snapshot"
-
-        disks_el = lxml.etree.Element("disks")
-        root_el.append(disks_el)
 
-        all_domain_disks = get_domain_disks_of(
-            defusedxml.lxml.fromstring(self.dom.XMLDesc())
+        The xml is a simple template, directly formatted instead of being
+        built as a tree then serialized.
+        """
+        dom_xml = self._dom_xml
+        if dom_xml is None:
+            dom_xml = parse_libvirt_xml(self.dom.XMLDesc())
+        all_domain_disks = get_domain_disks_of(dom_xml)
+
+        # Skipped disks need to have an entry, with a snapshot value
+        # explicitly set to "no", otherwise libvirt will be created a
+        # snapshot for them.
+        disks_xml = "".join(
+            "    <disk name={} snapshot=\"{}\"/>\n".format(
+                quoteattr(d), "external" if d in self.disks else "no"
+            ) for d in sorted(all_domain_disks.keys())
         )
-        for d in sorted(all_domain_disks.keys()):
-            disk_el = lxml.etree.Element("disk")
-            disk_el.attrib["name"] = d
-            # Skipped disks need to have an entry, with a snapshot value
-            # explicitly set to "no", otherwise libvirt will be created a
-            # snapshot for them.
-            disk_el.attrib["snapshot"] = (
-                "external" if d in self.disks else "no"
-            )
-            disks_el.append(disk_el)
-
-        return lxml.etree.tostring(xml_tree, pretty_print=True).decode()
+        return (
+            "<domainsnapshot>\n"
+            "  <description>Pre-backup external snapshot</description>\n"
+            "  <disks>\n"
+            "{}"
+            "  </disks>\n"
+            "</domainsnapshot>\n"
+        ).format(disks_xml)
 
     def _get_snapshot_path(self, parent_disk_path, snapshot):
         return "{}.{}".format(
@@ -192,7 +198,7 @@ class DomExtSnapshot():
 
         # Do not commit and pivot if our snapshot is not the current top disk
         current_disk_path = get_xml_block_of_disk(
-            self.dom.XMLDesc(), disk
+            parse_libvirt_xml(self.dom.XMLDesc()), disk
         ).xpath("source")[0].get("file")
         if os.path.abspath(current_disk_path) != snapshot_path:
             logger.warning(
@@ -280,7 +286,7 @@ class DomExtSnapshot():
         :param disk: disk name
         :param src: new disk path
         """
-        dom_xml = defusedxml.lxml.fromstring(self.dom.XMLDesc())
+        dom_xml = parse_libvirt_xml(self.dom.XMLDesc())
 
         disk_xml = get_xml_block_of_disk(dom_xml, disk)
         disk_xml.xpath("source")[0].set("file", src)
@@ -288,10 +294,10 @@ class DomExtSnapshot():
         if self.conn.getLibVersion() >= 3000000:
             # update a disk is broken in libvirt < 3.0
             return self.dom.updateDeviceFlags(
-                defusedxml.lxml.tostring(disk_xml).decode(),
+                lxml.etree.tostring(disk_xml).decode(),
                 libvirt.VIR_DOMAIN_AFFECT_CONFIG
             )
         else:
             return self.conn.defineXML(
-                defusedxml.lxml.tostring(dom_xml).decode()
+                lxml.etree.tostring(dom_xml).decode()
             )
@@ -1,10 +1,39 @@
 
 import defusedxml.lxml
+import lxml.etree
 import re
+import threading
 
 from virt_backup.exceptions import DiskNotFoundError
 
 
+#: path of the disk elements in a domain XML. ElementPath (find/iterfind) is
+#: used instead of xpath, which compiles the expression at each call.
+_DISKS_PATH = "devices/disk[@device='disk']"
+
+#: lxml parsers are not thread-safe, keep one by thread
+_libvirt_xml_parsers = threading.local()
+
+
+def parse_libvirt_xml(xml):
+    """
+    Parse a XML generated by libvirt
+
+    Libvirt XML is trusted, so it is parsed by lxml with a reused parser,
+    instead of defusedxml which builds a new one for each parse. Entities and
+    network access are still disabled.
+
+    :param xml: XML string, as returned by libvirt
+    """
+    parser = getattr(_libvirt_xml_parsers, "parser", None)
+    if parser is None:
+        parser = lxml.etree.XMLParser(
+            resolve_entities=False, no_network=True, huge_tree=False
+        )
+        _libvirt_xml_parsers.parser = parser
+    return lxml.etree.fromstring(xml, parser)
+
+
 def get_domain_disks_of(dom_xml, *filter_dev):
     """
     Get disks from the domain xml
@@ -16,26 +45,26 @@ def get_domain_disks_of(dom_xml, *filter_dev):
     """
     if isinstance(dom_xml, str):
         dom_xml = defusedxml.lxml.fromstring(dom_xml)
-    filter_dev = sorted(list(filter_dev))
+    filter_dev = set(filter_dev)
     disks = {}
-    for elem in dom_xml.xpath("devices/disk"):
-        try:
-            if elem.get("device", None) == "disk":
-                dev = elem.xpath("target")[0].get("dev")
-                if filter_dev and dev not in filter_dev:
-                    continue
-                src = elem.xpath("source")[0].get("file")
-                disk_type = elem.xpath("driver")[0].get("type")
-
-                disks[dev] = {"src": src, "type": disk_type}
-
-                # all disks captured
-                if filter_dev in list(sorted(disks.keys())):
-                    break
-        except IndexError:
+    for elem in dom_xml.iterfind(_DISKS_PATH):
+        target = elem.find("target")
+        if target is None:
+            continue
+        dev = target.get("dev")
+        if filter_dev and dev not in filter_dev:
+            continue
+        source, driver = elem.find("source"), elem.find("driver")
+        if source is None or driver is None:
             continue
 
-    for disk in filter_dev:
+        disks[dev] = {"src": source.get("file"), "type": driver.get("type")}
+
+        # all disks captured, no need to walk through the other ones
+        if filter_dev and len(disks) == len(filter_dev):
+            break
+
+    for disk in sorted(filter_dev):
         if disk not in disks:
             raise DiskNotFoundError(disk)
 
@@ -45,14 +74,10 @@ def get_domain_disks_of(dom_xml, *filter_dev):
 def get_xml_block_of_disk(dom_xml, disk):
     if isinstance(dom_xml, str):
         dom_xml = defusedxml.lxml.fromstring(dom_xml)
-    for elem in dom_xml.xpath("devices/disk"):
-        try:
-            if elem.get("device", None) == "disk":
-                dev = elem.xpath("target")[0].get("dev")
-                if dev == disk:
-                    return elem
-        except IndexError:
-            continue
+    for elem in dom_xml.iterfind(_DISKS_PATH):
+        target = elem.find("target")
+        if target is not None and target.get("dev") == disk:
+            return elem
     raise DiskNotFoundError(disk)
 
 
@@ -3,6 +3,11 @@ class BackupNotFoundError(Exception):
         super().__init__("backup not found")
 
 
+class BackupCancelledError(Exception):
+    def __init__(self, domain):
+        super().__init__("backup of domain {} cancelled".format(domain))
+
+
 class BackupsFailureInGroupError(Exception):
     def __init__(self, completed_backups, exceptions):
         """
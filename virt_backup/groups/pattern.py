@@ -1,4 +1,5 @@
 
+import functools
 import libvirt
 import logging
 import re
@@ -9,7 +10,7 @@ from virt_backup.domains import search_domains_regex
 logger = logging.getLogger("virt_backup")
 
 
-def matching_libvirt_domains_from_config(host, conn):
+def matching_libvirt_domains_from_config(host, conn, domain_names=None):
     """
     Return matching domains with the host definition
 
@@ -17,6 +18,7 @@ def matching_libvirt_domains_from_config(host, conn):
 
     :param host: domain name or custom regex to match on multiple domains
     :param conn: connection with libvirt
+    :param domain_names: names of all libvirt domains, if already listed
     :returns {"domains": (domain_name, ), "exclude": bool}: exclude will
         indicate if the domains need to be explicitly excluded of the backup
         group or not (for example, if a user wants to exclude all domains
@@ -35,7 +37,7 @@ def matching_libvirt_domains_from_config(host, conn):
                 "{}".format(host)
             )
             raise e
-    matches = pattern_matching_domains_in_libvirt(pattern, conn)
+    matches = pattern_matching_domains_in_libvirt(pattern, conn, domain_names)
     # not useful to continue if no domain matches or if the host variable
     # doesn't bring any property for our domain (like which disks to backup)
     if not isinstance(host, dict) or not matches["domains"]:
@@ -46,17 +48,23 @@ def matching_libvirt_domains_from_config(host, conn):
     return matches
 
 
-def pattern_matching_domains_in_libvirt(pattern, conn):
+def pattern_matching_domains_in_libvirt(pattern, conn, domain_names=None):
     """
     Parse the host pattern as written in the config and find matching hosts
 
     :param pattern: pattern to match on one or several domain names
     :param conn: connection with libvirt
+    :param domain_names: names of all libvirt domains, if already listed.
+                         Avoids to list them again for each regex.
     """
     exclude, pattern = _handle_possible_exclusion_host_pattern(pattern)
     if pattern.startswith("r:"):
         pattern = pattern[2:]
-        domains = search_domains_regex(pattern, conn)
+        if domain_names is None:
+            domains = search_domains_regex(pattern, conn)
+        else:
+            c_pattern = _compile(pattern)
+            domains = tuple(d for d in domain_names if c_pattern.match(d))
     elif pattern.startswith("g:"):
         domains = _include_group_domains(pattern)
     else:
@@ -97,7 +105,7 @@ def is_domain_matching_with(domain_name, pattern):
     exclude, pattern = _handle_possible_exclusion_host_pattern(pattern)
     if pattern.startswith("r:"):
         pattern = pattern[2:]
-        matches = re.match(pattern, domain_name)
+        matches = _compile(pattern).match(domain_name)
     elif pattern.startswith("g:"):
         # TODO: to implement
         matches = False
@@ -107,6 +115,15 @@ def is_domain_matching_with(domain_name, pattern):
     return {"matches": matches, "exclude": exclude}
 
 
+@functools.lru_cache(maxsize=512)
+def _compile(pattern):
+    """
+    Compile a regex, with cache as the same patterns are matched on every
+    domain
+    """
+    return re.compile(pattern)
+
+
 def _handle_possible_exclusion_host_pattern(pattern):
     """
     Check if pattern starts with "!", meaning matching hosts will be excluded
@@ -1,12 +1,15 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 import concurrent.futures
 import logging
 import multiprocessing
 import os
+import threading
 
 from virt_backup.backups import DomBackup, build_dom_complete_backup_from_def
 from virt_backup.domains import search_domains_regex
-from virt_backup.exceptions import BackupsFailureInGroupError
+from virt_backup.exceptions import (
+    BackupCancelledError, BackupsFailureInGroupError
+)
 from .pattern import matching_libvirt_domains_from_config
 
 
@@ -26,7 +29,9 @@ def groups_from_dict(groups_dict, conn, callbacks_registrer):
         hosts = properties.pop("hosts")
         include, exclude = [], []
         for host in hosts:
-            matches = matching_libvirt_domains_from_config(host, conn)
+            matches = matching_libvirt_domains_from_config(
+                host, conn, domain_names
+            )
             if not matches.get("domains", None):
                 continue
             if matches["exclude"]:
@@ -66,10 +71,36 @@ def groups_from_dict(groups_dict, conn, callbacks_registrer):
 
         return properties
 
+    # list the domains once for all groups, instead of for each regex
+    domain_names = tuple(d.name() for d in conn.listAllDomains())
     for group_name, group_properties in groups_dict.items():
         yield build(group_name, group_properties.copy())
 
 
+def _pop_or_steal(local_queues, worker_id):
+    """
+    Pop an item from the worker queue, or steal one from another queue
+
+    The worker pops from one side of its own queue, and steals from the other
+    side of the other queues, to limit the contention.
+
+    :returns: the item, or None if all queues are empty
+    """
+    try:
+        return local_queues[worker_id].pop()
+    except IndexError:
+        pass
+
+    nb_queues = len(local_queues)
+    for i in range(1, nb_queues):
+        try:
+            return local_queues[(worker_id + i) % nb_queues].popleft()
+        except IndexError:
+            continue
+
+    return None
+
+
 class BackupGroup():
     """
     Group of libvirt domain backups
@@ -85,6 +116,10 @@ class BackupGroup():
         #: list of DomBackup
         self.backups = list()
 
+        #: DomBackup objects by domain, to search them without going through
+        #  all backups
+        self._backups_by_dom = defaultdict(list)
+
         #: group name, "unnamed" by default
         self.name = name
 
@@ -120,7 +155,7 @@ class BackupGroup():
             existing_bak.add_disks(*disks)
         except StopIteration:
             # spawn a new DomBackup instance otherwise
-            self.backups.append(DomBackup(
+            self._append_backup(DomBackup(
                 dom=dom, dev_disks=disks, **self.default_bak_param
             ))
 
@@ -138,7 +173,11 @@ class BackupGroup():
                 existing_bak.merge_with(dombackup)
                 return
         else:
-            self.backups.append(dombackup)
+            self._append_backup(dombackup)
+
+    def _append_backup(self, dombackup):
+        self.backups.append(dombackup)
+        self._backups_by_dom[dombackup.dom].append(dombackup)
 
     def search(self, dom):
         """
@@ -148,9 +187,7 @@ class BackupGroup():
                     libvirt.virDomain object
         :returns: a generator of DomBackup matching
         """
-        for backup in self.backups:
-            if backup.dom == dom:
-                yield backup
+        yield from self._backups_by_dom.get(dom, ())
 
     def propagate_default_backup_attr(self):
         """
@@ -166,26 +203,14 @@ class BackupGroup():
 
         :returns results: dictionary of domain names and their backup
         """
-        completed_backups = {}
-        error_backups = {}
-
-        for b in self.backups:
-            dom_name = b.dom.name()
-            try:
-                completed_backups[dom_name] = self._start_backup(b)
-            except KeyboardInterrupt:
-                raise
-            except Exception as e:
-                error_backups[dom_name] = e
-                logger.error("Error with domain %s: %s", dom_name, e)
-                logger.exception(e)
+        completed_backups, error_backups = self._start_backups(self.backups)
 
         if error_backups:
             raise BackupsFailureInGroupError(completed_backups, error_backups)
         else:
             return completed_backups
 
-    def start_multithread(self, nb_threads=None):
+    def start_multithread(self, nb_threads=None, fail_fast=False):
         """
         Start all backups, multi threaded
 
@@ -195,49 +220,40 @@ class BackupGroup():
         created then removed, backups would copy the external snapshot of other
         running backups instead of the real disk.
 
-        To avoid this issue, a callback is set for each futures in order to
-        notify when they are completed, and put the completed domain in a
-        queue.
-        If no other backup is to do for this domain, it will be dropped,
-        otherwise a backup targeting this domain will be started.
+        To avoid this issue, all backups of a same domain are run by the same
+        worker, one after the other. Domains are distributed between one queue
+        per worker. When a worker emptied its own queue, it steals domains
+        from the queues of the other workers.
+
+        :param nb_threads: number of backups to run in parallel. Use all CPU
+                           threads if None.
+        :param fail_fast: if a backup fails, cancel the remaining ones. The
+                          running backups are aborted before their next disk
+                          copy.
         """
         nb_threads = nb_threads or multiprocessing.cpu_count()
+        cancel_event = threading.Event() if fail_fast else None
 
         backups_by_domain = self._group_backups_by_domain()
+        nb_workers = max(min(nb_threads, len(backups_by_domain)), 1)
+
+        # deque pops are atomic, so queues can be shared without lock
+        local_queues = [deque() for _ in range(nb_workers)]
+        for i, backups_for_domain in enumerate(backups_by_domain.values()):
+            local_queues[i % nb_workers].append(backups_for_domain)
 
         completed_backups = {}
         error_backups = {}
-
-        completed_doms = []
-        futures = {}
-        with concurrent.futures.ThreadPoolExecutor(nb_threads) as executor:
-            for backups_for_domain in backups_by_domain.values():
-                backup = backups_for_domain.pop()
-                future = self._submit_backup_future(
-                    executor, backup, completed_doms
-                )
-                futures[future] = backup.dom
-
-            while len(futures) < len(self.backups):
-                next(concurrent.futures.as_completed(futures))
-                dom = completed_doms.pop()
-                if backups_by_domain.get(dom):
-                    backup = backups_by_domain[dom].pop()
-                    future = self._submit_backup_future(
-                        executor, backup, completed_doms
-                    )
-                    futures[future] = backup.dom
-
-        for f in concurrent.futures.as_completed(futures):
-            dom_name = futures[f].name()
-            try:
-                completed_backups[dom_name] = f.result()
-            except KeyboardInterrupt:
-                raise
-            except Exception as e:
-                error_backups[dom_name] = e
-                logger.error("Error with domain %s: %s", dom_name, e)
-                logger.exception(e)
+        with concurrent.futures.ThreadPoolExecutor(nb_workers) as executor:
+            futures = [
+                executor.submit(
+                    self._run_backups_worker, i, local_queues, cancel_event
+                ) for i in range(nb_workers)
+            ]
+            for f in concurrent.futures.as_completed(futures):
+                worker_completed_backups, worker_error_backups = f.result()
+                completed_backups.update(worker_completed_backups)
+                error_backups.update(worker_error_backups)
 
         if error_backups:
             raise BackupsFailureInGroupError(completed_backups, error_backups)
@@ -245,27 +261,72 @@ class BackupGroup():
             return completed_backups
 
     def _group_backups_by_domain(self):
-        backups_by_domain = defaultdict(list)
-        for b in self.backups:
-            backups_by_domain[b.dom].append(b)
+        return {
+            dom: list(backups)
+            for dom, backups in self._backups_by_dom.items()
+        }
 
-        return backups_by_domain
+    def _run_backups_worker(self, worker_id, local_queues, cancel_event=None):
+        """
+        Run the backups of the domains in its queue, then in the other queues
+
+        :param worker_id: index of the worker queue in local_queues
+        :param local_queues: list of deques, one per worker, containing lists
+            of backups for a same domain
+        :param cancel_event: see `_start_backups`
+        :returns completed_backups, error_backups: dictionaries of domain names
+            and their backup or exception
+        """
+        completed_backups = {}
+        error_backups = {}
+
+        backups_for_domain = _pop_or_steal(local_queues, worker_id)
+        while backups_for_domain is not None:
+            completed, errors = self._start_backups(
+                backups_for_domain, cancel_event
+            )
+            completed_backups.update(completed)
+            error_backups.update(errors)
 
-    def _submit_backup_future(self, executor, backup, completed_doms: list):
+            backups_for_domain = _pop_or_steal(local_queues, worker_id)
+
+        return completed_backups, error_backups
+
+    def _start_backups(self, backups, cancel_event=None):
         """
-        :param completed_doms: list where a completed backup will append its
-            domain.
+        Start backups one after the other
+
+        :param cancel_event: threading.Event. If given, it is set when a backup
+            fails, and the backups not started yet are then cancelled.
+        :returns completed_backups, error_backups: dictionaries of domain names
+            and their backup or exception
         """
-        future = executor.submit(self._start_backup, backup)
-        future.add_done_callback(
-            lambda *args: completed_doms.append(backup.dom)
-        )
+        completed_backups = {}
+        error_backups = {}
+
+        for b in backups:
+            dom_name = b.dom.name()
+            if cancel_event is not None and cancel_event.is_set():
+                error_backups[dom_name] = BackupCancelledError(dom_name)
+                continue
+            try:
+                completed_backups[dom_name] = self._start_backup(
+                    b, cancel_event
+                )
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                error_backups[dom_name] = e
+                logger.error("Error with domain %s: %s", dom_name, e)
+                logger.exception(e)
+                if cancel_event is not None:
+                    cancel_event.set()
 
-        return future
+        return completed_backups, error_backups
 
-    def _start_backup(self, backup):
+    def _start_backup(self, backup, cancel_event=None):
         self._ensure_backup_is_set_in_domain_dir(backup)
-        return backup.start()
+        return backup.start(cancel_event=cancel_event)
 
     def _ensure_backup_is_set_in_domain_dir(self, dombackup):
         """
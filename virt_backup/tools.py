@@ -1,15 +1,403 @@
+import errno
+import fcntl
+import io
+import json
+import logging
 import os
-import re
-import shutil
+import stat
+import sys
 import tarfile
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def copy_file(src, dst, buffersize=None):
-    if not os.path.exists(dst) and dst.endswith("/"):
-        os.makedirs(dst)
-    if os.path.isdir(dst):
+
+logger = logging.getLogger("virt_backup")
+
+
+def positive_int_from_env(name, default):
+    """
+    Read a positive integer from an environment variable
+
+    An invalid value is ignored with a warning, to not prevent virt-backup
+    to start because of a typo.
+
+    :param name: name of the environment variable
+    :param default: value returned if the variable is not set or invalid
+    """
+    value = os.environ.get(name, None)
+    if value is None:
+        return default
+    try:
+        parsed_value = int(value)
+    except ValueError:
+        parsed_value = 0
+    if parsed_value <= 0:
+        logger.warning(
+            "%s has to be a positive integer, got %r: use %s",
+            name, value, default
+        )
+        return default
+    return parsed_value
+
+
+#: buffer size used to copy big files, as disk images. Can be tuned for the
+#: storage backend through the VIRT_BACKUP_COPY_BUFSIZE environment variable.
+DEFAULT_COPY_BUFSIZE = positive_int_from_env(
+    "VIRT_BACKUP_COPY_BUFSIZE", 4 * 1024 * 1024
+)
+
+#: ioctl cloning a file on copy-on-write filesystems, from linux/fs.h
+FICLONE = 0x40049409
+
+#: copy_file_range is only exposed since python 3.8
+_HAS_COPY_FILE_RANGE = hasattr(os, "copy_file_range")
+
+#: posix_fadvise is not available on all platforms
+_HAS_FADVISE = hasattr(os, "posix_fadvise")
+
+#: posix_fallocate is not available on all platforms
+_HAS_FALLOCATE = hasattr(os, "posix_fallocate")
+
+#: sendfile only accepts a regular file as output on Linux
+_USE_SENDFILE = hasattr(os, "sendfile") and sys.platform.startswith("linux")
+
+#: errors meaning that a copy method is not supported for these files
+_UNSUPPORTED_COPY_ERRNOS = (
+    errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP, errno.EXDEV
+)
+
+
+def dump_json(obj, path):
+    """
+    Dump obj as json into path
+
+    The json is written in a temporary file then renamed, to never leave a
+    truncated file if the process is killed during the dump. orjson is used
+    if installed, as it is much faster than the json module.
+    """
+    tmp_path = "{}.tmp".format(path)
+    if orjson is not None:
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(tmp_path, "w") as f:
+            json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def ensure_dir(path):
+    """
+    Create a directory and its parents if it does not exist
+
+    Cheaper than checking if the directory exists first, or than
+    `os.makedirs(path, exist_ok=True)`, when the directory already exists.
+
+    :returns: True if the directory has been created
+    """
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        return False
+    except FileNotFoundError:
+        os.makedirs(path, exist_ok=True)
+    return True
+
+
+def copy_file(src, dst, buffersize=None, *, advise=True, try_reflink=True,
+              use_sendfile=True, preallocate=False):
+    """
+    Copy src into dst
+
+    :param src: path of the file to copy
+    :param dst: destination path. If it is a directory, or ends with a "/",
+                src is copied in it with the same name.
+    :param buffersize: size of the chunks if the copy has to be done in
+                       userspace
+    :param advise: advise the kernel that src is read sequentially, and that
+                   the copied data will not be needed again, to avoid filling
+                   the page cache with a disk image
+    :param try_reflink: clone src on copy-on-write filesystems, instead of
+                        copying its data. The copy then shares its extents
+                        with src until one of them is modified.
+    :param use_sendfile: use sendfile if copy_file_range is not supported
+    :param preallocate: allocate the destination before the copy, if src is
+                        not sparse. Disabled by default: on filesystems not
+                        supporting fallocate (NFSv3…), glibc emulates it by
+                        writing each block of the destination.
+    :returns: the destination path
+    """
+    if dst.endswith("/"):
+        ensure_dir(dst)
+        is_dir = True
+    else:
+        try:
+            is_dir = stat.S_ISDIR(os.stat(dst).st_mode)
+        except FileNotFoundError:
+            is_dir = False
+    if is_dir:
         dst = os.path.join(dst, os.path.basename(src))
 
     with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
-        shutil.copyfileobj(fsrc, fdst, buffersize)
+        if advise:
+            _fadvise(fsrc, "POSIX_FADV_SEQUENTIAL")
+        _fastcopy(
+            fsrc, fdst, buffersize or DEFAULT_COPY_BUFSIZE,
+            try_reflink=try_reflink, use_sendfile=use_sendfile,
+            preallocate=preallocate
+        )
+        if advise:
+            fdst.flush()
+            _fadvise(fsrc, "POSIX_FADV_DONTNEED")
+            _fadvise(fdst, "POSIX_FADV_DONTNEED")
     return dst
+
+
+def _fastcopy(fsrc, fdst, buffersize, try_reflink=True, use_sendfile=True,
+              preallocate=False):
+    """
+    Copy fsrc into fdst with the fastest method supported
+
+    In order: clone the file, copy it in kernel space with copy_file_range
+    then sendfile, or copy it by chunks of buffersize as last resort. Each
+    method continues from where the previous one stopped.
+    """
+    if try_reflink and _reflink(fsrc, fdst):
+        return
+    if preallocate:
+        _preallocate(fsrc, fdst)
+    if _copy_file_range(fsrc, fdst):
+        return
+    if use_sendfile and _sendfile(fsrc, fdst):
+        return
+    _copyfileobj_readinto(fsrc, fdst, buffersize)
+
+
+def _fadvise(f, advice):
+    """
+    Advise the kernel about how the whole file f will be accessed
+
+    As it is only an optimization, errors (unsupported file type or
+    platform) are ignored.
+
+    :param advice: name of the advice in the os module
+    """
+    if not _HAS_FADVISE:
+        return
+    try:
+        os.posix_fadvise(f.fileno(), 0, 0, getattr(os, advice))
+    except OSError:
+        pass
+
+
+def _reflink(fsrc, fdst):
+    """
+    Clone fsrc as fdst, without copying any data
+
+    Only supported by copy-on-write filesystems (btrfs, xfs…).
+
+    :returns: True if the file has been cloned
+    """
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError as e:
+        if e.errno in _UNSUPPORTED_COPY_ERRNOS:
+            return False
+        raise
+    return True
+
+
+def _preallocate(fsrc, fdst):
+    """
+    Reserve in fdst the space needed to copy fsrc
+
+    Allocating the whole file at once limits its fragmentation. It is
+    skipped if fsrc is sparse, as the copy would then not be sparse anymore.
+    """
+    if not _HAS_FALLOCATE:
+        return
+
+    src_stat = os.fstat(fsrc.fileno())
+    is_sparse = src_stat.st_blocks * 512 < src_stat.st_size
+    if not src_stat.st_size or is_sparse:
+        return
+    try:
+        os.posix_fallocate(fdst.fileno(), 0, src_stat.st_size)
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED_COPY_ERRNOS:
+            raise
+
+
+def _copy_file_range(fsrc, fdst):
+    """
+    Copy fsrc into fdst in kernel space, with copy_file_range
+
+    If copy_file_range fails in the middle of the copy, the file offsets
+    stay where the copy stopped, so another method can finish it.
+
+    :returns: True if the file has been entirely copied
+    """
+    if not _HAS_COPY_FILE_RANGE:
+        return False
+
+    src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+    total_copied = 0
+    while True:
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, 2 ** 30)
+        except OSError as e:
+            if e.errno in _UNSUPPORTED_COPY_ERRNOS:
+                return False
+            raise
+        if not copied:
+            break
+        total_copied += copied
+
+    # some filesystems return 0 without copying anything, do not trust this
+    # end of file and let another method finish the copy
+    if not total_copied:
+        return False
+    dst_offset = os.lseek(dst_fd, 0, os.SEEK_CUR)
+    return dst_offset == os.fstat(src_fd).st_size
+
+
+def _sendfile(fsrc, fdst):
+    """
+    Copy fsrc into fdst in kernel space, with sendfile
+
+    The copy starts from the current offsets, so it can finish a copy
+    started by another method, and leaves them where the copy stopped.
+
+    :returns: True if the file has been entirely copied
+    """
+    if not _USE_SENDFILE:
+        return False
+
+    src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+    offset = os.lseek(src_fd, 0, os.SEEK_CUR)
+    try:
+        while True:
+            try:
+                sent = os.sendfile(dst_fd, src_fd, offset, 2 ** 30)
+            except OSError as e:
+                if e.errno in _UNSUPPORTED_COPY_ERRNOS:
+                    return False
+                raise
+            if not sent:
+                return True
+            offset += sent
+    finally:
+        # sendfile does not move the source offset when one is given
+        os.lseek(src_fd, offset, os.SEEK_SET)
+
+
+def _copyfileobj_readinto(fsrc, fdst, length):
+    """
+    Copy fsrc into fdst, reusing the same buffer for each chunk
+
+    Same as `shutil.copyfileobj`, without allocating a new bytes object for
+    each chunk read.
+    """
+    if length <= 0:
+        raise ValueError(
+            "buffer size has to be positive, got {}".format(length)
+        )
+    with memoryview(bytearray(length)) as mv:
+        while True:
+            n = fsrc.readinto(mv)
+            if not n:
+                break
+            elif n < length:
+                with mv[:n] as smv:
+                    fdst.write(smv)
+            else:
+                fdst.write(mv)
+
+
+def add_file_to_tar(tar, src, arcname, advise=True):
+    """
+    Add a file into a tar
+
+    Equivalent to `tar.add(src, arcname=arcname)`, but the content of a
+    regular file is directly sent with `os.sendfile` when the tar is not
+    compressed, or copied with a large buffer otherwise.
+
+    :param tar: tarfile.TarFile opened in write mode
+    :param src: path of the file to add
+    :param arcname: name of the file in the tar
+    :param advise: see `copy_file`. Only applied on src, as the tar can be a
+                   stream.
+    """
+    tarinfo = tar.gettarinfo(src, arcname=arcname)
+    if not tarinfo.isreg():
+        return tar.add(src, arcname=arcname)
+
+    buf = tarinfo.tobuf(tar.format, tar.encoding, tar.errors)
+    tar.fileobj.write(buf)
+    tar.offset += len(buf)
+
+    with open(src, "rb") as fsrc:
+        if advise:
+            _fadvise(fsrc, "POSIX_FADV_SEQUENTIAL")
+        sent = 0
+        is_uncompressed_tar = isinstance(tar.fileobj, io.BufferedWriter)
+        if is_uncompressed_tar and _USE_SENDFILE:
+            sent = _sendfile_exactly(fsrc, tar.fileobj, tarinfo.size)
+        if sent < tarinfo.size:
+            _copyfileobj_exactly(
+                fsrc, tar.fileobj, tarinfo.size - sent, DEFAULT_COPY_BUFSIZE
+            )
+        if advise:
+            _fadvise(fsrc, "POSIX_FADV_DONTNEED")
+
+    blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+    if remainder > 0:
+        tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    tar.offset += blocks * tarfile.BLOCKSIZE
+    tar.members.append(tarinfo)
+
+
+def _sendfile_exactly(fsrc, fdst, size):
+    """
+    Send size bytes of fsrc into fdst, in kernel space
+
+    Both files are left positioned after the sent data, so the copy can be
+    finished by another method if sendfile is not supported.
+
+    :returns: number of bytes sent, lower than size if sendfile stopped
+    """
+    fdst.flush()
+    src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+    offset = 0
+    while offset < size:
+        try:
+            sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+        except OSError as e:
+            if e.errno in _UNSUPPORTED_COPY_ERRNOS:
+                break
+            raise
+        if not sent:
+            raise OSError("unexpected end of data")
+        offset += sent
+
+    # sendfile moved the destination offset but not the source one,
+    # synchronize the buffered file objects
+    fsrc.seek(offset)
+    fdst.seek(os.lseek(dst_fd, 0, os.SEEK_CUR))
+    return offset
+
+
+def _copyfileobj_exactly(fsrc, fdst, size, bufsize):
+    """
+    Copy size bytes of fsrc into fdst
+    """
+    remaining = size
+    while remaining:
+        buf = fsrc.read(min(bufsize, remaining))
+        if not buf:
+            raise OSError("unexpected end of data")
+        fdst.write(buf)
+        remaining -= len(buf)